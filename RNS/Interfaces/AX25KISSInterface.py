@@ -21,12 +21,20 @@
 # SOFTWARE.
 
 from .Interface import Interface
+from collections import deque
 from time import sleep
 import sys
 import threading
 import time
 import RNS
 
+# The serial module is optional, and only needed
+# once an AX.25 KISS interface is actually created
+try:
+    import serial
+except ImportError:
+    serial = None
+
 class KISS():
     FEND              = 0xC0
     FESC              = 0xDB
@@ -43,22 +51,48 @@ class KISS():
     CMD_READY         = 0x0F
     CMD_RETURN        = 0xFF
 
+    DATA_FRAME_START  = bytes([FEND, CMD_DATA])
+    DATA_FRAME_END    = bytes([FEND])
+
     @staticmethod
     def escape(data):
         data = data.replace(bytes([0xdb]), bytes([0xdb, 0xdd]))
         data = data.replace(bytes([0xc0]), bytes([0xdb, 0xdc]))
         return data
 
+    @staticmethod
+    def unescape(data):
+        # Every FESC in a well-formed frame starts a two byte
+        # escape sequence, so substituting FESC+TFEND before
+        # FESC+TFESC can never match across sequence borders
+        data = data.replace(bytes([0xdb, 0xdc]), bytes([0xc0]))
+        data = data.replace(bytes([0xdb, 0xdd]), bytes([0xdb]))
+        return data
+
+    @staticmethod
+    def command(command, value):
+        return bytes([KISS.FEND, command, value, KISS.FEND])
+
 class AX25():
     PID_NOLAYER3    = 0xF0
     CTRL_UI         = 0x03
     CRC_CORRECT     = bytes([0xF0])+bytes([0xB8])
     HEADER_SIZE     = 16
+    ADDR_SHIFT      = bytes([(i << 1) & 0xFF for i in range(256)])
+
+    @staticmethod
+    def encode_call(call):
+        # Shift each callsign character left by one bit as
+        # required in the address field, and pad it out to
+        # the fixed six character field length
+        return call[:6].translate(AX25.ADDR_SHIFT).ljust(6, bytes([0x20]))
 
 
 class AX25KISSInterface(Interface):
     MAX_CHUNK = 32768
     BITRATE_GUESS = 1200
+    READ_TIMEOUT  = 0.05
+    PACKET_QUEUE_LEN = 64
 
     owner    = None
     port     = None
@@ -69,10 +103,7 @@ class AX25KISSInterface(Interface):
     serial   = None
 
     def __init__(self, owner, name, callsign, ssid, port, speed, databits, parity, stopbits, preamble, txtail, persistence, slottime, flow_control):
-        import importlib
-        if importlib.util.find_spec('serial') != None:
-            import serial
-        else:
+        if serial == None:
             RNS.log("Using the AX.25 KISS interface requires a serial communication module to be installed.", RNS.LOG_CRITICAL)
             RNS.log("You can install one with the command: python3 -m pip install pyserial", RNS.LOG_CRITICAL)
             RNS.panic()
@@ -98,11 +129,18 @@ class AX25KISSInterface(Interface):
         self.online   = False
         self.bitrate  = KISSInterface.BITRATE_GUESS
 
-        self.packet_queue    = []
+        self.packet_queue    = deque(maxlen=AX25KISSInterface.PACKET_QUEUE_LEN)
         self.flow_control    = flow_control
         self.interface_ready = False
         self.flow_control_timeout = 5
-        self.flow_control_locked  = time.time()
+        self.flow_control_locked  = time.monotonic()
+
+        # Received frames are buffered in their escaped form,
+        # which can take up to twice the space of the frame
+        self.rx_buffer = bytearray((self.HW_MTU+AX25.HEADER_SIZE)*2+1)
+        self.rx_in_frame = False
+        self.rx_command = KISS.CMD_UNKNOWN
+        self.rx_len = 0
 
         if (len(self.src_call) < 3 or len(self.src_call) > 6):
             raise ValueError("Invalid callsign for "+str(self))
@@ -110,6 +148,17 @@ class AX25KISSInterface(Interface):
         if (self.src_ssid < 0 or self.src_ssid > 15):
             raise ValueError("Invalid SSID for "+str(self))
 
+        # The address and control fields never change for
+        # the lifetime of the interface, so build them once
+        encoded_dst_ssid = bytes([0x60 | (self.dst_ssid << 1)])
+        encoded_src_ssid = bytes([0x60 | (self.src_ssid << 1) | 0x01])
+
+        addr  = AX25.encode_call(self.dst_call)+encoded_dst_ssid
+        addr += AX25.encode_call(self.src_call)+encoded_src_ssid
+
+        self.ax25_header = addr+bytes([AX25.CTRL_UI])+bytes([AX25.PID_NOLAYER3])
+        self.kiss_frame_start = KISS.DATA_FRAME_START+KISS.escape(self.ax25_header)
+
         self.preamble    = preamble if preamble != None else 350;
         self.txtail      = txtail if txtail != None else 20;
         self.persistence = persistence if persistence != None else 64;
@@ -142,7 +191,7 @@ class AX25KISSInterface(Interface):
             stopbits = self.stopbits,
             xonxoff = False,
             rtscts = False,
-            timeout = 0,
+            timeout = AX25KISSInterface.READ_TIMEOUT,
             inter_byte_timeout = None,
             write_timeout = None,
             dsrdtr = False,
@@ -157,66 +206,86 @@ class AX25KISSInterface(Interface):
         self.online = True
         RNS.log("Serial port "+self.port+" is now open")
         RNS.log("Configuring AX.25 KISS interface parameters...")
-        self.setPreamble(self.preamble)
-        self.setTxTail(self.txtail)
-        self.setPersistence(self.persistence)
-        self.setSlotTime(self.slottime)
-        self.setFlowControl(self.flow_control)
+
+        # Send all configuration commands in a single write
+        kiss_commands = b"".join([
+            self.preambleCommand(self.preamble),
+            self.txTailCommand(self.txtail),
+            self.persistenceCommand(self.persistence),
+            self.slotTimeCommand(self.slottime),
+            self.flowControlCommand(self.flow_control),
+        ])
+        written = self.serial.write(kiss_commands)
+        if written != len(kiss_commands):
+            raise IOError("Could not configure AX.25 KISS interface parameters, only wrote "+str(written)+" bytes of "+str(len(kiss_commands)))
+
         self.interface_ready = True
         RNS.log("AX.25 KISS interface configured")
 
-    def setPreamble(self, preamble):
-        preamble_ms = preamble
-        preamble = int(preamble_ms / 10)
+    def preambleCommand(self, preamble):
+        preamble = int(preamble / 10)
         if preamble < 0:
             preamble = 0
         if preamble > 255:
             preamble = 255
 
-        kiss_command = bytes([KISS.FEND])+bytes([KISS.CMD_TXDELAY])+bytes([preamble])+bytes([KISS.FEND])
-        written = self.serial.write(kiss_command)
-        if written != len(kiss_command):
-            raise IOError("Could not configure AX.25 KISS interface preamble to "+str(preamble_ms)+" (command value "+str(preamble)+")")
+        return KISS.command(KISS.CMD_TXDELAY, preamble)
 
-    def setTxTail(self, txtail):
-        txtail_ms = txtail
-        txtail = int(txtail_ms / 10)
+    def txTailCommand(self, txtail):
+        txtail = int(txtail / 10)
         if txtail < 0:
             txtail = 0
         if txtail > 255:
             txtail = 255
 
-        kiss_command = bytes([KISS.FEND])+bytes([KISS.CMD_TXTAIL])+bytes([txtail])+bytes([KISS.FEND])
-        written = self.serial.write(kiss_command)
-        if written != len(kiss_command):
-            raise IOError("Could not configure AX.25 KISS interface TX tail to "+str(txtail_ms)+" (command value "+str(txtail)+")")
+        return KISS.command(KISS.CMD_TXTAIL, txtail)
 
-    def setPersistence(self, persistence):
+    def persistenceCommand(self, persistence):
         if persistence < 0:
             persistence = 0
         if persistence > 255:
             persistence = 255
 
-        kiss_command = bytes([KISS.FEND])+bytes([KISS.CMD_P])+bytes([persistence])+bytes([KISS.FEND])
-        written = self.serial.write(kiss_command)
-        if written != len(kiss_command):
-            raise IOError("Could not configure AX.25 KISS interface persistence to "+str(persistence))
+        return KISS.command(KISS.CMD_P, persistence)
 
-    def setSlotTime(self, slottime):
-        slottime_ms = slottime
-        slottime = int(slottime_ms / 10)
+    def slotTimeCommand(self, slottime):
+        slottime = int(slottime / 10)
         if slottime < 0:
             slottime = 0
         if slottime > 255:
             slottime = 255
 
-        kiss_command = bytes([KISS.FEND])+bytes([KISS.CMD_SLOTTIME])+bytes([slottime])+bytes([KISS.FEND])
+        return KISS.command(KISS.CMD_SLOTTIME, slottime)
+
+    def flowControlCommand(self, flow_control):
+        return KISS.command(KISS.CMD_READY, 0x01)
+
+    def setPreamble(self, preamble):
+        kiss_command = self.preambleCommand(preamble)
         written = self.serial.write(kiss_command)
         if written != len(kiss_command):
-            raise IOError("Could not configure AX.25 KISS interface slot time to "+str(slottime_ms)+" (command value "+str(slottime)+")")
+            raise IOError("Could not configure AX.25 KISS interface preamble to "+str(preamble)+" (command value "+str(kiss_command[2])+")")
+
+    def setTxTail(self, txtail):
+        kiss_command = self.txTailCommand(txtail)
+        written = self.serial.write(kiss_command)
+        if written != len(kiss_command):
+            raise IOError("Could not configure AX.25 KISS interface TX tail to "+str(txtail)+" (command value "+str(kiss_command[2])+")")
+
+    def setPersistence(self, persistence):
+        kiss_command = self.persistenceCommand(persistence)
+        written = self.serial.write(kiss_command)
+        if written != len(kiss_command):
+            raise IOError("Could not configure AX.25 KISS interface persistence to "+str(persistence))
+
+    def setSlotTime(self, slottime):
+        kiss_command = self.slotTimeCommand(slottime)
+        written = self.serial.write(kiss_command)
+        if written != len(kiss_command):
+            raise IOError("Could not configure AX.25 KISS interface slot time to "+str(slottime)+" (command value "+str(kiss_command[2])+")")
 
     def setFlowControl(self, flow_control):
-        kiss_command = bytes([KISS.FEND])+bytes([KISS.CMD_READY])+bytes([0x01])+bytes([KISS.FEND])
+        kiss_command = self.flowControlCommand(flow_control)
         written = self.serial.write(kiss_command)
         if written != len(kiss_command):
             if (flow_control):
@@ -228,6 +297,10 @@ class AX25KISSInterface(Interface):
     def processIncoming(self, data):
         if (len(data) > AX25.HEADER_SIZE):
             self.rxb += len(data)
+            # The payload is handed over as bytes and not as a
+            # memoryview, since the transport keeps the raw
+            # packet around and relies on bytes semantics for
+            # it, such as ord() on slices and concatenation.
             self.owner.inbound(data[AX25.HEADER_SIZE:], self)
 
 
@@ -237,32 +310,11 @@ class AX25KISSInterface(Interface):
             if self.interface_ready:
                 if self.flow_control:
                     self.interface_ready = False
-                    self.flow_control_locked = time.time()
-
-                encoded_dst_ssid = bytes([0x60 | (self.dst_ssid << 1)])
-                encoded_src_ssid = bytes([0x60 | (self.src_ssid << 1) | 0x01])
+                    self.flow_control_locked = time.monotonic()
 
-                addr = b""
-
-                for i in range(0,6):
-                    if (i < len(self.dst_call)):
-                        addr += bytes([self.dst_call[i]<<1])
-                    else:
-                        addr += bytes([0x20])
-                addr += encoded_dst_ssid
-
-                for i in range(0,6):
-                    if (i < len(self.src_call)):
-                        addr += bytes([self.src_call[i]<<1])
-                    else:
-                        addr += bytes([0x20])
-                addr += encoded_src_ssid
-
-                data = addr+bytes([AX25.CTRL_UI])+bytes([AX25.PID_NOLAYER3])+data
-
-                data = data.replace(bytes([0xdb]), bytes([0xdb])+bytes([0xdd]))
-                data = data.replace(bytes([0xc0]), bytes([0xdb])+bytes([0xdc]))
-                kiss_frame = bytes([KISS.FEND])+bytes([0x00])+data+bytes([KISS.FEND])
+                # The header is escaped in advance, so only the
+                # payload needs to be scanned for escape bytes
+                kiss_frame = b"".join([self.kiss_frame_start, KISS.escape(data), KISS.DATA_FRAME_END])
 
                 written = self.serial.write(kiss_frame)
                 self.txb += datalen
@@ -275,67 +327,141 @@ class AX25KISSInterface(Interface):
                 self.queue(data)
 
     def queue(self, data):
+        # The queue is bounded, so if the device stays
+        # unavailable, the oldest packets are dropped
+        if len(self.packet_queue) == self.packet_queue.maxlen:
+            RNS.log("Packet queue for "+str(self)+" is full, dropping oldest queued packet", RNS.LOG_DEBUG)
         self.packet_queue.append(data)
 
     def process_queue(self):
         if len(self.packet_queue) > 0:
-            data = self.packet_queue.pop(0)
+            data = self.packet_queue.popleft()
             self.interface_ready = True
             self.processOutgoing(data)
         elif len(self.packet_queue) == 0:
             self.interface_ready = True
 
+    def decode(self, chunk):
+        # Runs the KISS receive state machine over a chunk
+        # of bytes read from the port. The decoder state is
+        # carried over between chunks on the interface, and
+        # a list of (command, data) tuples is returned for
+        # every completed data frame and received READY.
+        #
+        # Frame delimiters are located with bytes.find, and
+        # the bytes between them are copied as whole slices,
+        # so only frame boundaries are handled per byte.
+        FEND = KISS.FEND
+        CMD_DATA = KISS.CMD_DATA
+        CMD_READY = KISS.CMD_READY
+        CMD_UNKNOWN = KISS.CMD_UNKNOWN
+
+        # READY indications are only acted on when
+        # flow control is enabled for the interface
+        flow_control = self.flow_control
+
+        in_frame = self.rx_in_frame
+        command = self.rx_command
+        rx_buffer = self.rx_buffer
+        rx_len = self.rx_len
+        frame_limit = self.HW_MTU+AX25.HEADER_SIZE
+        escaped_limit = len(rx_buffer)
+        decoded = []
+
+        position = 0
+        chunk_len = len(chunk)
+        while position < chunk_len:
+            if not in_frame:
+                # Skip anything outside of a frame
+                start = chunk.find(FEND, position)
+                if start == -1:
+                    break
+                in_frame = True
+                command = CMD_UNKNOWN
+                rx_len = 0
+                position = start+1
+
+            elif command == CMD_UNKNOWN:
+                byte = chunk[position]
+                position += 1
+                if byte != FEND:
+                    # We only support one HDLC port for now, so
+                    # strip off the port nibble
+                    command = byte & 0x0F
+
+            else:
+                end = chunk.find(FEND, position)
+                segment_end = chunk_len if end == -1 else end
+
+                if command == CMD_DATA:
+                    if end != -1 and rx_len == 0:
+                        # The whole frame is contained in this
+                        # chunk, so it can be sliced out directly
+                        frame = chunk[position:min(end, position+escaped_limit)]
+                    else:
+                        copy_len = min(segment_end-position, escaped_limit-rx_len)
+                        rx_buffer[rx_len:rx_len+copy_len] = chunk[position:position+copy_len]
+                        rx_len += copy_len
+                        frame = None
+
+                    if end != -1:
+                        if frame == None:
+                            frame = bytes(memoryview(rx_buffer)[:rx_len])
+                        decoded.append((CMD_DATA, KISS.unescape(frame)[:frame_limit]))
+                        in_frame = False
+
+                elif flow_control and command == CMD_READY:
+                    for i in range(segment_end-position):
+                        decoded.append((CMD_READY, None))
+
+                if end == -1:
+                    position = chunk_len
+                else:
+                    position = end+1
+                    if command != CMD_DATA:
+                        # A FEND within any other frame type
+                        # starts a new frame
+                        command = CMD_UNKNOWN
+                        rx_len = 0
+
+        self.rx_in_frame = in_frame
+        self.rx_command = command
+        self.rx_len = rx_len
+
+        return decoded
+
     def readLoop(self):
         try:
-            in_frame = False
-            escape = False
-            command = KISS.CMD_UNKNOWN
-            data_buffer = b""
-            last_read_ms = int(time.time()*1000)
+            self.rx_in_frame = False
+            self.rx_command = KISS.CMD_UNKNOWN
+            self.rx_len = 0
+            last_read_ms = int(time.monotonic()*1000)
 
             while self.serial.is_open:
-                if self.serial.in_waiting:
-                    byte = ord(self.serial.read(1))
-                    last_read_ms = int(time.time()*1000)
-
-                    if (in_frame and byte == KISS.FEND and command == KISS.CMD_DATA):
-                        in_frame = False
-                        self.processIncoming(data_buffer)
-                    elif (byte == KISS.FEND):
-                        in_frame = True
-                        command = KISS.CMD_UNKNOWN
-                        data_buffer = b""
-                    elif (in_frame and len(data_buffer) < self.HW_MTU+AX25.HEADER_SIZE):
-                        if (len(data_buffer) == 0 and command == KISS.CMD_UNKNOWN):
-                            # We only support one HDLC port for now, so
-                            # strip off the port nibble
-                            byte = byte & 0x0F
-                            command = byte
-                        elif (command == KISS.CMD_DATA):
-                            if (byte == KISS.FESC):
-                                escape = True
-                            else:
-                                if (escape):
-                                    if (byte == KISS.TFEND):
-                                        byte = KISS.FEND
-                                    if (byte == KISS.TFESC):
-                                        byte = KISS.FESC
-                                    escape = False
-                                data_buffer = data_buffer+bytes([byte])
+                # If nothing is waiting, this blocks until the first
+                # byte arrives or the port read timeout expires. On
+                # POSIX systems pyserial waits for this with select()
+                # on the port descriptor, so no separate selector is
+                # needed for the reader thread.
+                chunk = self.serial.read(max(1, self.serial.in_waiting))
+                if len(chunk) > 0:
+                    last_read_ms = int(time.monotonic()*1000)
+
+                    for command, data in self.decode(chunk):
+                        if (command == KISS.CMD_DATA):
+                            self.processIncoming(data)
                         elif (command == KISS.CMD_READY):
                             self.process_queue()
                 else:
-                    time_since_last = int(time.time()*1000) - last_read_ms
-                    if len(data_buffer) > 0 and time_since_last > self.timeout:
-                        data_buffer = b""
-                        in_frame = False
-                        command = KISS.CMD_UNKNOWN
-                        escape = False
-                    sleep(0.05)
+                    time_since_last = int(time.monotonic()*1000) - last_read_ms
+                    if self.rx_len > 0 and time_since_last > self.timeout:
+                        self.rx_in_frame = False
+                        self.rx_command = KISS.CMD_UNKNOWN
+                        self.rx_len = 0
 
                     if self.flow_control:
                         if not self.interface_ready:
-                            if time.time() > self.flow_control_locked + self.flow_control_timeout:
+                            if time.monotonic() > self.flow_control_locked + self.flow_control_timeout:
                                 RNS.log("Interface "+str(self)+" is unlocking flow control due to time-out. This should not happen. Your hardware might have missed a flow-control READY command, or maybe it does not support flow-control.", RNS.LOG_WARNING)
                                 self.process_queue()
 